@@ -1,9 +1,13 @@
+import gc
+import shutil
+import warnings
+import numpy as np
 import pytest
 from spiropredict import calculators as calc
 # Fixture for Calculator instance
 @pytest.fixture
 def calculator():
-    return calc.Calculator()
+    return calc.default_calculator()
 
 def test_predict_fev1(calculator):
     test_male = 0
@@ -59,3 +63,191 @@ def test_invalid_input(calculator):
     with pytest.raises(ValueError):
         calculator.predict_fev1(2, 30, 170)  # An invalid gender value
 
+
+def test_age_not_in_lookup(calculator):
+    with pytest.raises(ValueError):
+        calculator.predict_fev1(1, 30.1, 170)  # ages are tabulated every quarter year
+    with pytest.raises(ValueError):
+        calculator.zscore_fvc(0, 2, 120, 1.5)  # below the youngest tabulated age
+
+def test_vectorized_matches_scalar(calculator):
+    test_male = np.array([0, 1, 1, 0])
+    test_age = np.array([95, 75, 30.25, 50])
+    test_height = np.array([190, 170, 180, 150])
+    test_measured = np.array([2.478, 3.471, 4.2, 0.824])
+    for param in ('fev1', 'fvc', 'fev1fvc'):
+        predicted = getattr(calculator, f'predict_{param}')(test_male, test_age, test_height)
+        zscores = getattr(calculator, f'zscore_{param}')(test_male, test_age, test_height, test_measured)
+        for i in range(len(test_male)):
+            args = (test_male[i], test_age[i], test_height[i])
+            assert predicted[i] == pytest.approx(getattr(calculator, f'predict_{param}')(*args))
+            assert zscores[i] == pytest.approx(getattr(calculator, f'zscore_{param}')(*args, test_measured[i]))
+
+def test_vectorized_invalid_input(calculator):
+    with pytest.raises(ValueError):
+        calculator.predict_fev1(np.array([0, 2]), np.array([30, 30]), np.array([170, 170]))
+
+def _copy_lookup_csv(tmp_path):
+    csv_path = tmp_path / "lookup.csv"
+    shutil.copy(calc.Path(calc.__file__).parent / "data" / "gli_global_lookuptables_dec6.csv", csv_path)
+    with open(csv_path, 'ab') as csv_file:
+        csv_file.write(b"\n")  # same table, different contents than the bundled csv
+    return csv_path
+
+def _cache_files(csv_path):
+    return sorted(csv_path.parent.glob('lookup.*.splines.npy'))
+
+def test_table_cache(calculator, tmp_path):
+    csv_path = _copy_lookup_csv(tmp_path)
+    digest = calc._digest(csv_path.read_bytes())
+    calc.Calculator._TABLE_CACHE.pop(digest, None)
+    parsed = calc.Calculator(csv_path)
+    assert _cache_files(csv_path) == [calc._cache_path(csv_path, digest)]
+    assert calc.Calculator(csv_path).table is parsed.table
+    # load from the .npy rather than the in-process cache
+    del calc.Calculator._TABLE_CACHE[digest]
+    cached = calc.Calculator(csv_path)
+    assert isinstance(cached.table.base, np.memmap)
+    np.testing.assert_array_equal(parsed.table, cached.table)
+    np.testing.assert_array_equal(calculator.table, cached.table)
+
+def test_table_cache_replaced_on_edit(calculator, tmp_path):
+    csv_path = _copy_lookup_csv(tmp_path)
+    digest = calc._digest(csv_path.read_bytes())
+    calc.Calculator._TABLE_CACHE.pop(digest, None)
+    calc.Calculator(csv_path)  # dropped right away, so the next instance loads from the .npy
+    mapped = calc.Calculator(csv_path)
+    assert isinstance(mapped.table.base, np.memmap)
+    before = mapped.predict_fev1(1, 30, 170)
+    # edit the csv without changing its size or mtime
+    stat = csv_path.stat()
+    csv_path.write_bytes(csv_path.read_bytes().replace(b"30,0.121249596,", b"30,0.521249596,"))
+    assert csv_path.stat().st_size == stat.st_size
+    calc.os.utime(csv_path, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    edited = calc.Calculator(csv_path)
+    assert edited.predict_fev1(1, 30, 170) != pytest.approx(before)
+    # the old mapping is untouched, and only the new cache is left
+    assert mapped.predict_fev1(1, 30, 170) == before
+    assert _cache_files(csv_path) == [calc._cache_path(csv_path, calc._digest(csv_path.read_bytes()))]
+
+def test_invalid_measured(calculator):
+    with pytest.raises(ValueError):
+        calculator.zscore_fev1(1, 40, 170, 0)
+    with pytest.raises(ValueError, match=r"FVC must be >0L \(subject 1: male=1, age=40, measured_fvc=-1\.0\)"):
+        calculator.zscore_fvc(np.array([0, 1]), np.array([40, 40]), np.array([170, 170]), np.array([3.0, -1.0]))
+    with pytest.raises(ValueError, match=r"subject 0: male=1, age=30, measured_fev1=nan"):
+        calculator.batch_score(np.array([1, 0]), np.array([30, 40]), 170, measured_fev1=np.array([np.nan, 3.0]))
+
+def test_invalid_height(calculator):
+    for height in (0, -170, float('nan')):
+        with pytest.raises(ValueError, match="Height must be >0cm"):
+            calculator.predict_fev1(1, 40, height)
+        with pytest.raises(ValueError, match="Height must be >0cm"):
+            calculator.zscore_fev1(1, 40, height, 3.0)
+    with pytest.raises(ValueError, match=r"subject 1: male=0, age=40\.0, height=-170"):
+        calculator.predict_fvc(np.array([1, 0]), np.array([30, 40.0]), np.array([170, -170]))
+    with pytest.raises(ValueError, match="Height must be >0cm"):
+        calculator.batch_score(np.array([1, 0]), np.array([30, 40]), 0)
+
+def test_lookup_error_messages(calculator):
+    with pytest.raises(ValueError, match="sex"):
+        calculator.zscore_fev1(-1, 30, 170, 3.0)  # must not wrap around to the male row
+    with pytest.raises(ValueError, match="not present in lookup"):
+        calculator.predict_fev1fvc(0, 120, 170)
+
+def test_batch_score(calculator):
+    test_male = np.array([0, 1, 1, 0])
+    test_age = np.array([95, 75, 30.25, 50])
+    test_height = np.array([190, 170, 180, 150])
+    test_fev1 = np.array([2.478, 2.9, 4.2, 2.5])
+    test_fvc = np.array([3.1, 3.471, 5.0, 3.0])
+    test_fev1fvc = test_fev1 / test_fvc
+    result = calculator.batch_score(test_male, test_age, test_height, test_fev1, test_fvc, test_fev1fvc,
+                                    dtype=np.float64)
+    for param, measured in (('fev1', test_fev1), ('fvc', test_fvc), ('fev1fvc', test_fev1fvc)):
+        np.testing.assert_allclose(result[f'predicted_{param}'],
+                                   getattr(calculator, f'predict_{param}')(test_male, test_age, test_height))
+        np.testing.assert_allclose(result[f'zscore_{param}'],
+                                   getattr(calculator, f'zscore_{param}')(test_male, test_age, test_height, measured))
+
+def test_batch_score_without_measurements(calculator):
+    result = calculator.batch_score(np.array([0, 1]), np.array([40, 60]), np.array([160, 175]))
+    assert set(result) == {'predicted_fev1', 'predicted_fvc', 'predicted_fev1fvc'}
+
+def test_batch_score_float32(calculator):
+    test_male = np.array([0, 1, 1, 0])
+    test_age = np.array([95, 75, 30.25, 50])
+    test_height = np.array([190, 170, 180, 150])
+    test_fev1 = np.array([2.478, 2.9, 4.2, 2.5])
+    result32 = calculator.batch_score(test_male, test_age, test_height, test_fev1, dtype=np.float32)
+    result64 = calculator.batch_score(test_male, test_age, test_height, test_fev1)
+    assert result32['zscore_fev1'].dtype == np.float32
+    np.testing.assert_allclose(result32['predicted_fev1'], result64['predicted_fev1'], rtol=1e-5)
+    np.testing.assert_allclose(result32['zscore_fev1'], result64['zscore_fev1'], atol=1e-4)
+
+def test_default_calculator():
+    assert calc.default_calculator() is calc.default_calculator()
+    assert calc.predict_fev1(0, 95, 190) == calc.default_calculator().predict_fev1(0, 95, 190)
+    assert round(calc.zscore_fev1fvc(0, 50, 150, 0.824), 2) == 0
+
+def test_vectorized_invalid_sex_checked_before_cast(calculator):
+    with warnings.catch_warnings():
+        warnings.simplefilter("error")
+        for method in (calculator.predict_fev1, calculator.batch_score):
+            with pytest.raises(ValueError, match=r"subject 1: male=nan"):
+                method(np.array([1, np.nan]), np.array([30, 40]), np.array([170, 170]))
+
+def test_vectorized_invalid_subject_reported(calculator):
+    with pytest.raises(ValueError, match=r"subject 2: male=1, age=2\.0"):
+        calculator.batch_score(np.array([0, 1, 1]), np.array([30, 40, 2.0]), np.array([160, 170, 180]))
+
+def test_table_shared_between_instances(calculator):
+    assert calc.Calculator().table is calculator.table
+
+def test_table_rejects_off_grid_and_duplicate_ages(tmp_path):
+    csv_path = tmp_path / "lookup.csv"
+    header = "Age,M Spline,S Spline,L Spline,Male,Param\n"
+    csv_path.write_text(header + "30,0.1,0.2,0,1,fev1\n30.1,99.0,0.2,0,1,fev1\n")
+    with pytest.raises(ValueError, match="multiples"):
+        calc.Calculator(csv_path)
+    csv_path.write_text(header + "30,0.1,0.2,0,1,fev1\n30.0,99.0,0.2,0,1,fev1\n")
+    with pytest.raises(ValueError, match="duplicate"):
+        calc.Calculator(csv_path)
+
+def test_table_from_non_path_sources(calculator, tmp_path):
+    csv_path = calc.Path(calc.__file__).parent / "data" / "gli_global_lookuptables_dec6.csv"
+    with open(csv_path) as csv_file:
+        from_buffer = calc.Calculator(csv_file)
+    from_url = calc.Calculator(csv_path.as_uri())
+    for loaded in (from_buffer, from_url):
+        np.testing.assert_array_equal(loaded.table, calculator.table)
+        assert loaded.predict_fev1(1, 30, 170) == calculator.predict_fev1(1, 30, 170)
+    with pytest.raises(FileNotFoundError):
+        calc.Calculator(tmp_path / "missing.csv")
+
+def test_dropped_calculator_freed_without_gc(tmp_path):
+    csv_path = _copy_lookup_csv(tmp_path)
+    digest = calc._digest(csv_path.read_bytes())
+    calc.Calculator._TABLE_CACHE.pop(digest, None)
+    gc.disable()
+    try:
+        calculator = calc.Calculator(csv_path)
+        calculator.predict_fev1(1, 30, 170)
+        assert digest in calc.Calculator._TABLE_CACHE
+        del calculator
+        assert digest not in calc.Calculator._TABLE_CACHE
+    finally:
+        gc.enable()
+
+def test_table_cache_ignores_foreign_npy(calculator, tmp_path):
+    csv_path = _copy_lookup_csv(tmp_path)
+    np.save(csv_path.with_suffix('.npy'), np.arange(5))  # unrelated user file with the same stem
+    np.save(tmp_path / "lookup.extra.splines.npy", np.arange(5))  # not named by a digest
+    # cache with the wrong layout
+    digest = calc._digest(csv_path.read_bytes())
+    np.save(calc._cache_path(csv_path, digest), np.zeros((3, 3)))
+    calc.Calculator._TABLE_CACHE.pop(digest, None)
+    loaded = calc.Calculator(csv_path)
+    np.testing.assert_array_equal(loaded.table, calculator.table)
+    np.testing.assert_array_equal(np.load(csv_path.with_suffix('.npy')), np.arange(5))
+    np.testing.assert_array_equal(np.load(tmp_path / "lookup.extra.splines.npy"), np.arange(5))